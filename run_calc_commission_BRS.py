@@ -1,10 +1,36 @@
 import pandas as pd
+import numpy as np
 import os
-import chardet
-from openpyxl.styles import PatternFill
+import re
+import time
+import codecs
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
+from functools import partial
+from multiprocessing import freeze_support
 
-start_time = datetime.now()
+try:
+    from cchardet import detect  # C-реализация, значительно быстрее chardet
+except ImportError:
+    from chardet import detect
+
+# Заливки для условного форматирования (формат xlsxwriter)
+GREEN_FILL = {'bg_color': '#00FF00'}
+RED_FILL = {'bg_color': '#FF0000'}
+GRAY_FILL = {'bg_color': '#DDDDDD'}
+
+# Входные файлы: csv, xlsx, xls, dsv, dsvp, кроме results*, setup.xlsx и уже обработанных копий
+INPUT_FILE_PATTERN = re.compile(
+    r'^(?!results)(?!.*_processed\.(xlsx|xls|csv)$)(?!setup\.xlsx$).*\.(xlsx|xls|csv|dsv|dsvp)$',
+    re.IGNORECASE
+)
+
+# Параметры чтения CSV. Разделитель тысяч не задается: он действовал бы на все колонки
+# (текст вида '4276 1234' стал бы числом). Суммы с пробелами разбирает convert_amount
+CSV_READ_OPTIONS = {
+    'delimiter': ';',
+    'decimal': ',',
+}
 
 
 def load_commission_rates():
@@ -29,11 +55,10 @@ def load_commission_rates():
             print("Файл setup.xlsx пуст, используются ставки по умолчанию")
             return default_rates
 
-        commission_rates = {}
-        for _, row in df.iterrows():
-            card_type = str(row['Тип карты']).strip().upper()
-            rate = float(row['Ставка комиссии'])
-            commission_rates[card_type] = rate
+        commission_rates = dict(zip(
+            df['Тип карты'].astype(str).str.strip().str.upper(),
+            df['Ставка комиссии'].astype(float)
+        ))
 
         commission_rates.setdefault('DEFAULT', default_rates['DEFAULT'])
         return commission_rates
@@ -44,65 +69,136 @@ def load_commission_rates():
 
 
 def detect_encoding(file_path):
-    """Определяет кодировку файла"""
+    """Определяет кодировку файла по первым 64 КБ"""
     with open(file_path, 'rb') as f:
-        raw_data = f.read(10000)
-    return chardet.detect(raw_data)['encoding']
+        raw_data = f.read(65536)
+
+    # При наличии BOM кодировка известна без запуска детектора
+    if raw_data.startswith(codecs.BOM_UTF8):
+        return 'utf-8-sig'
+    if raw_data.startswith((codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)):
+        return 'utf-16'
+
+    # Банк присылает UTF-8 или Windows-1251, проверяем их до запуска детектора.
+    # Инкрементальный декодер не падает на символе, обрезанном границей выборки.
+    # Windows-1251 не декодирует только байт 0x98, поэтому детектор нужен лишь для таких файлов
+    for encoding in ('utf-8', 'windows-1251'):
+        try:
+            codecs.getincrementaldecoder(encoding)().decode(raw_data, final=False)
+            return encoding
+        except UnicodeDecodeError:
+            continue
+    return detect(raw_data)['encoding'] or 'windows-1251'
+
+
+def read_excel_file(file_path):
+    """Читает Excel-файл через calamine, а без него - стандартным движком pandas"""
+    try:
+        return pd.read_excel(file_path, engine='calamine')
+    except ImportError:
+        return pd.read_excel(file_path)
 
 
 def read_file_with_encoding(file_path):
     """Читает файл с автоматическим определением кодировки и разделителя"""
     try:
-        if file_path.endswith(('.csv', '.dsv', '.dsvp')):
-            # Пробуем UTF-8 с разделителем ;
+        if file_path.lower().endswith(('.csv', '.dsv', '.dsvp')):
+            # Кодировка определяется один раз, файл разбирается одним вызовом read_csv
+            encoding = detect_encoding(file_path)
             try:
-                df = pd.read_csv(file_path, encoding='utf-8', delimiter=';', decimal=',')
-                return df, 'utf-8'
+                df = pd.read_csv(file_path, encoding=encoding, **CSV_READ_OPTIONS)
             except UnicodeDecodeError:
-                try:
-                    # Пробуем Windows-1251 с разделителем ;
-                    df = pd.read_csv(file_path, encoding='windows-1251', delimiter=';', decimal=',')
-                    return df, 'windows-1251'
-                except UnicodeDecodeError:
-                    # Пробуем определить кодировку автоматически
-                    encoding = detect_encoding(file_path)
-                    df = pd.read_csv(file_path, encoding=encoding, delimiter=';', decimal=',')
-                    return df, encoding
+                # Недекодируемые байты встретились за пределами проверенной выборки (или детектор ошибся).
+                # Последняя попытка - Windows-1251 с заменой таких байтов, чтобы файл не был пропущен
+                encoding = 'windows-1251'
+                df = pd.read_csv(file_path, encoding=encoding, encoding_errors='replace', **CSV_READ_OPTIONS)
+            return df, encoding
         else:
-            df = pd.read_excel(file_path)
+            df = read_excel_file(file_path)
             return df, None
     except Exception as e:
         raise ValueError(f"Ошибка чтения файла {file_path}: {str(e)}")
 
 
-def convert_amount(value):
-    """Конвертирует сумму в float, обрабатывая разные форматы"""
-    if isinstance(value, str):
-        # Удаляем пробелы как разделители тысяч и заменяем запятую на точку
-        value = value.replace(' ', '').replace(',', '.')
-    return float(value)
+def convert_amount(series):
+    """Конвертирует колонку сумм в float, обрабатывая разные форматы"""
+    if series.dtype == np.float64:
+        return series
+    if pd.api.types.is_numeric_dtype(series):
+        return series.astype(float)
+    # Удаляем пробелы как разделители тысяч и заменяем запятую на точку
+    cleaned = series.astype(str).str.replace(' ', '', regex=False).str.replace(',', '.', regex=False)
+    return pd.to_numeric(cleaned, errors='coerce')
+
+
+def calculate_commission(is_buy, amount, commission, rates):
+    """Рассчитывает комиссию и разницу (F - U) только для строк с покупкой, остальные остаются 0.0
+
+    Комиссия округляется так же, как встроенный round (в том числе на значениях вида x.xx5):
+
+    >>> calc, diff = calculate_commission(np.array([True, True]), np.array([61141.25, 101466.5]),
+    ...                                   np.array([1222.83, 3043.99]), np.array([0.02, 0.03]))
+    >>> calc.tolist(), diff.tolist()
+    ([1222.83, 3043.99], [0.0, 0.0])
+    """
+    # Операции пишут сразу в выходные массивы, без промежуточных копий
+    calc = np.zeros_like(amount)
+    np.multiply(amount, rates, out=calc, where=is_buy)
+
+    # np.round расходится с round на почти-половинах (1222.825 -> 1222.82 вместо 1222.83),
+    # поэтому такие значения пересчитываются встроенным round, как в построчном расчете
+    ties = np.flatnonzero(np.abs((calc * 100) % 1 - 0.5) < 1e-6)
+    exact = [round(value, 2) for value in calc[ties].tolist()]
+    np.round(calc, 2, out=calc)
+    calc[ties] = exact
+
+    diff = np.zeros_like(amount)
+    np.subtract(commission, calc, out=diff, where=is_buy)
+    np.round(diff, 2, out=diff)
+    return calc, diff
+
+
+def add_highlighting(writer, df, diff_col, calc_col=None):
+    """Окрашивает колонку разницы (и при необходимости расчетной комиссии) условным форматированием"""
+    last_row = len(df)
+    if not last_row:
+        return
+
+    wb = writer.book
+    ws = writer.sheets['Sheet1']
+    green = wb.add_format(GREEN_FILL)
+    red = wb.add_format(RED_FILL)
+    gray = wb.add_format(GRAY_FILL)
+
+    column_rules = [
+        # Разница: отрицательная - красная, нулевая - серая, положительная - зеленая
+        (diff_col, [('<', red), ('==', gray), ('>', green)]),
+    ]
+    if calc_col is not None:
+        # Расчетная комиссия: нулевая - серая, ненулевая - зеленая
+        column_rules.append((calc_col, [('==', gray), ('!=', green)]))
 
+    for col_name, rules in column_rules:
+        col = df.columns.get_loc(col_name)
+        # Пустые ячейки не окрашиваем
+        ws.conditional_format(1, col, last_row, col, {'type': 'blanks', 'stop_if_true': True})
+        for criteria, fmt in rules:
+            ws.conditional_format(1, col, last_row, col,
+                                  {'type': 'cell', 'criteria': criteria, 'value': 0, 'format': fmt})
 
-def calculate_commission(row, commission_rates):
-    """Рассчитывает комиссию с проверкой типа операции"""
-    if row['TYPE'] != 'ПОКУПКА':
-        return 0.0
 
-    try:
-        card_type = str(row['PMT_SYSTEM_CODE']).strip().upper()
-        amount = convert_amount(row['AMOUNT'])
-        rate = commission_rates.get(card_type, commission_rates['DEFAULT'])
-        commission = round(amount * rate, 2)
-        return commission
-    except Exception as e:
-        print(f"Ошибка расчета комиссии для строки: {row}. Ошибка: {str(e)}")
-        return 0.0
+def get_processed_path(file_path):
+    """Возвращает путь к обработанной копии файла"""
+    base_name = os.path.splitext(os.path.basename(file_path))[0]
+    return os.path.join(os.path.dirname(file_path), f"{base_name}_processed.xlsx")
 
 
-def process_file(file_path, results_df, commission_rates):
-    """Обрабатывает один файл и возвращает обновленный DataFrame с расхождениями"""
+def process_file(file_path, commission_rates):
+    """Обрабатывает один файл и возвращает кортеж (DataFrame с расхождениями или None, путь к новому файлу, ошибка)
+
+    Сообщения не печатаются здесь: при параллельной обработке main выводит их сгруппированно по файлам.
+    """
     try:
-        print(f"\nОбработка файла: {os.path.basename(file_path)}")
         df, original_encoding = read_file_with_encoding(file_path)
 
         # Проверка необходимых колонок
@@ -112,126 +208,125 @@ def process_file(file_path, results_df, commission_rates):
             raise ValueError(f"Отсутствуют обязательные колонки: {', '.join(missing_columns)}")
 
         # Конвертируем числовые колонки
-        df['AMOUNT'] = df['AMOUNT'].apply(convert_amount)
-        df['COMMISSION'] = df['COMMISSION'].apply(convert_amount)
-
-        # Добавляем расчетные колонки
-        df['Комиссия (расчет)'] = df.apply(lambda row: calculate_commission(row, commission_rates), axis=1)
-        df['Разница (F - U)'] = df.apply(
-            lambda row: (row['COMMISSION'] - row['Комиссия (расчет)']) if row['TYPE'] == 'ПОКУПКА' else 0.0,
-            axis=1
+        df['AMOUNT'] = convert_amount(df['AMOUNT'])
+        df['COMMISSION'] = convert_amount(df['COMMISSION'])
+
+        # Добавляем расчетные колонки (векторно, без построчного apply)
+        # Ставка ищется один раз на тип карты, затем раздается по строкам через коды категорий
+        codes = df['PMT_SYSTEM_CODE'].astype(str).str.strip().str.upper().astype('category')
+        rate_table = np.array([commission_rates.get(card_type, commission_rates['DEFAULT'])
+                               for card_type in codes.cat.categories], dtype=np.float64)
+        rates = rate_table[codes.cat.codes.to_numpy()]
+        calc, diff = calculate_commission(
+            (df['TYPE'] == 'ПОКУПКА').to_numpy(),
+            df['AMOUNT'].to_numpy(dtype=np.float64),
+            df['COMMISSION'].to_numpy(dtype=np.float64),
+            rates,
         )
-        df['Разница (F - U)'] = df['Разница (F - U)'].round(2)
+        df['Комиссия (расчет)'] = calc
+        df['Разница (F - U)'] = diff
 
         # Сохраняем ВСЕ расхождения (отличные от нуля)
-        discrepancies = df[df['Разница (F - U)'] != 0].copy()
-        if not discrepancies.empty:
+        idx = np.flatnonzero(diff != 0.0)
+        if idx.size:
+            discrepancies = df.iloc[idx].copy()
             discrepancies['Файл'] = os.path.basename(file_path)
-            results_df = pd.concat([results_df, discrepancies], ignore_index=True)
+        else:
+            discrepancies = None
 
         # Сохраняем файл в XLSX
-        base_name = os.path.splitext(os.path.basename(file_path))[0]
-        new_path = os.path.join(os.path.dirname(file_path), f"{base_name}_processed.xlsx")
+        new_path = get_processed_path(file_path)
 
-        with pd.ExcelWriter(new_path, engine='openpyxl') as writer:
+        with pd.ExcelWriter(new_path, engine='xlsxwriter') as writer:
             df.to_excel(writer, index=False)
-            wb = writer.book
-            ws = wb.active
+            add_highlighting(writer, df, 'Разница (F - U)', calc_col='Комиссия (расчет)')
 
-            # Окрашивание
-            u_col = df.columns.get_loc('Комиссия (расчет)') + 1
-            v_col = df.columns.get_loc('Разница (F - U)') + 1
+        return discrepancies, new_path, None
 
-            green_fill = PatternFill(start_color='00FF00', end_color='00FF00', fill_type='solid')
-            red_fill = PatternFill(start_color='FF0000', end_color='FF0000', fill_type='solid')
-            gray_fill = PatternFill(start_color='DDDDDD', end_color='DDDDDD', fill_type='solid')
-
-            for row in ws.iter_rows(min_row=2, max_row=ws.max_row, min_col=u_col, max_col=v_col):
-                if row[0].value is not None:  # Колонка U
-                    row[0].fill = green_fill if row[0].value != 0 else gray_fill
+    except Exception as e:
+        return None, None, f"Ошибка при обработке файла {file_path}: {str(e)}"
 
-                if row[1].value is not None:  # Колонка V
-                    if row[1].value == 0:  # Нулевая разница
-                        row[1].fill = gray_fill
-                    elif row[1].value < 0:  # Отрицательная разница
-                        row[1].fill = red_fill
-                    else:  # Положительная разница
-                        row[1].fill = green_fill
 
-        print(f"Файл обработан и сохранен как: {new_path}")
-        return results_df
-
-    except Exception as e:
-        print(f"Ошибка при обработке файла {file_path}: {str(e)}")
-        return results_df
+def process_file_group(file_paths, commission_rates):
+    """Последовательно обрабатывает файлы с общим путем обработанной копии и возвращает список результатов"""
+    return [process_file(file_path, commission_rates) for file_path in file_paths]
 
 
 def main():
     """Основная функция программы"""
+    t0 = time.perf_counter()
+
     # Загружаем ставки комиссий
     commission_rates = load_commission_rates()
     print("Используемые ставки комиссий:", commission_rates)
 
-    # Создаем пустой DataFrame для результатов
-    results_df = pd.DataFrame()
-
     # Получаем список файлов для обработки
     current_dir = os.getcwd()
-    processed_files = [
-        os.path.join(current_dir, f) for f in os.listdir(current_dir)
-        if (f.endswith('.xlsx') or f.endswith('.xls') or
-            f.endswith('.csv') or f.endswith('.dsv') or f.endswith('.dsvp'))
-           and not f.startswith('results')
-           and not f.endswith('_processed.xlsx')
-           and not f.endswith('_processed.xls')
-           and not f.endswith('_processed.csv')
-           and f != 'setup.xlsx'
-    ]
+    with os.scandir(current_dir) as entries:
+        processed_files = [
+            entry.path for entry in entries
+            if entry.is_file() and INPUT_FILE_PATTERN.match(entry.name)
+        ]
 
     if not processed_files:
         print("Не найдено файлов для обработки")
-        return results_df
+        return pd.DataFrame()
 
-    # Обрабатываем файлы
+    # Файлы с одним именем и разными расширениями (a.csv и a.xlsx) пишут в один a_processed.xlsx,
+    # поэтому обрабатываются одной группой последовательно, как раньше: последний перезаписывает файл
+    groups = {}
     for file_path in processed_files:
-        results_df = process_file(file_path, results_df, commission_rates)
+        groups.setdefault(get_processed_path(file_path), []).append(file_path)
+    groups = list(groups.values())
+
+    # Группы обрабатываются параллельно, каждая независима от остальных.
+    # Для одной группы пул не создаем - запуск процесса дороже самой обработки
+    worker = partial(process_file_group, commission_rates=commission_rates)
+    workers = min(len(groups), os.cpu_count() or 1)
+    executor = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+    frames = []
+    try:
+        # Результаты выводятся по мере готовности, в порядке групп
+        group_results = executor.map(worker, groups) if executor else map(worker, groups)
+        for file_paths, results in zip(groups, group_results):
+            for file_path, (discrepancies, new_path, error) in zip(file_paths, results):
+                print(f"\nОбработка файла: {os.path.basename(file_path)}")
+                if error is not None:
+                    print(error)
+                    continue
+                print(f"Файл обработан и сохранен как: {new_path}")
+                if discrepancies is not None:
+                    frames.append(discrepancies)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    results_df = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
 
     # Сохраняем результаты
     results_path = os.path.join(current_dir, 'results.xlsx')
-    if os.path.exists(results_path):
-        open(results_path, 'w').close()
+    # Удаляем результат прошлого запуска, чтобы не оставить устаревший файл, если расхождений нет
+    try:
+        os.remove(results_path)
+    except FileNotFoundError:
+        pass
 
     if not results_df.empty:
         results_df['Время обработки'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
 
-        with pd.ExcelWriter(results_path, engine='openpyxl') as writer:
+        with pd.ExcelWriter(results_path, engine='xlsxwriter') as writer:
             results_df.to_excel(writer, index=False)
-            wb = writer.book
-            ws = wb.active
-
-            red_fill = PatternFill(start_color='FF0000', end_color='FF0000', fill_type='solid')
-            green_fill = PatternFill(start_color='00FF00', end_color='00FF00', fill_type='solid')
-            gray_fill = PatternFill(start_color='DDDDDD', end_color='DDDDDD', fill_type='solid')
-
-            diff_col = results_df.columns.get_loc('Разница (F - U)') + 1
-            for row in ws.iter_rows(min_row=2, max_row=ws.max_row, min_col=diff_col, max_col=diff_col):
-                if row[0].value is not None:
-                    if row[0].value == 0:
-                        row[0].fill = gray_fill
-                    elif row[0].value < 0:
-                        row[0].fill = red_fill
-                    else:
-                        row[0].fill = green_fill
+            add_highlighting(writer, results_df, 'Разница (F - U)')
 
         print(f"\nСводный файл с расхождениями сохранен как: {results_path}")
         print(f"Всего найдено расхождений (≠0): {len(results_df)}")
     else:
         print("\nРасхождений (≠0) не обнаружено")
-    print(f'Программа завершилась за {datetime.now() - start_time}')
+    print(f'Программа завершилась за {time.perf_counter() - t0:.3f} сек')
     print('Нажмите на ENTER для продолжения')
     input()
     return results_df
 
 
 if __name__ == "__main__":
+    freeze_support()  # Нужно для ProcessPoolExecutor в сборке PyInstaller под Windows
     results = main()
\ No newline at end of file